@@ -1,13 +1,110 @@
 from enum import Enum
 import json
-from logging import getLogger, NullHandler
-from typing import Dict, Tuple
+from logging import getLogger, NullHandler, DEBUG, INFO
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
 import aiohttp
 
+try:
+    import orjson
+
+    _loads = orjson.loads
+    _dumpb = orjson.dumps
+
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+
+except ImportError:
+    _loads = json.loads
+
+    def _dumpb(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+    def _dumps(obj) -> str:
+        return json.dumps(obj, ensure_ascii=False)
+
+
+class _LazyJSON:
+    # Defers serialization until a log record is actually formatted
+    __slots__ = ("obj",)
+
+    def __init__(self, obj) -> None:
+        self.obj = obj
+
+    def __str__(self) -> str:
+        return _dumps(self.obj)
+
 
 logger = getLogger(__name__)
 logger.addHandler(NullHandler())
 
+# Fields copied from stream events into response_data
+_MESSAGE_FILE_FIELDS = (
+    "url",
+    "id",
+    "type",
+    "belongs_to",
+    "conversation_id",
+)
+_WORKFLOW_STARTED_FIELDS = (
+    "task_id",
+    "workflow_run_id",
+    "data",
+    "id",
+    "workflow_id",
+    "sequence_number",
+    "created_at",
+)
+_WORKFLOW_ENDED_FIELDS = (
+    "task_id",
+    "workflow_run_id",
+    "data",
+    "id",
+    "workflow_id",
+    "status",
+    "outputs",
+    "error",
+    "elapsed_time",
+    "total_tokens",
+    "total_steps",
+    "created_at",
+    "finished_at",
+)
+_NODE_STARTED_FIELDS = (
+    "task_id",
+    "workflow_run_id",
+    "data",
+    "id",
+    "node_id",
+    "node_type",
+    "title",
+    "index",
+    "predecessor_node_id",
+    "inputs",
+    "created_at",
+)
+_NODE_FINISHED_FIELDS = (
+    "task_id",
+    "workflow_run_id",
+    "data",
+    "id",
+    "node_id",
+    "node_type",
+    "title",
+    "index",
+    "predecessor_node_id",
+    "inputs",
+    "process_data",
+    "outputs",
+    "status",
+    "error",
+    "elapsed_time",
+    "execution_metadata",
+    "total_tokens",
+    "total_price",
+    "currency",
+    "created_at",
+)
+
 
 class DifyType(Enum):
     Agent = "Agent"
@@ -17,25 +114,58 @@ class DifyType(Enum):
 
 
 class DifyAgent:
-    def __init__(self, *, api_key: str, base_url: str, user: str, type: DifyType = DifyType.Agent, verbose: bool = False) -> None:
+    def __init__(self, *, api_key: str, base_url: str, user: str, type: DifyType = DifyType.Agent, verbose: bool = False, connector_kwargs: dict = None) -> None:
         self.verbose = verbose
         self.api_key = api_key
         self.base_url = base_url
         self.user = user
         self.type = type
+        self.connector_kwargs = {
+            "limit": 0,
+            "limit_per_host": 32,
+            "ttl_dns_cache": 300,
+            **(connector_kwargs or {})
+        }
         self.response_processors = {
             DifyType.Agent: self.process_agent_response,
             DifyType.Chatbot: self.process_chatbot_response,
             DifyType.TextGenerator: self.process_textgenerator_response,
             DifyType.Workflow: self.process_workflow_response
         }
+        self._response_processor = self.response_processors[self.type]
+        self._response_stream_processor = {
+            DifyType.Agent: self.process_agent_response_stream,
+            DifyType.Workflow: self.process_workflow_response_stream
+        }.get(self.type, self._process_blocking_response_stream)
+        self._agent_handlers = {
+            "agent_message": self._handle_message,
+            "agent_thought": self._handle_agent_thought,
+            "message_end": self._handle_message_end,
+            "message_file": self._handle_message_file
+        }
+        self._workflow_handlers = {
+            "message": self._handle_message,
+            "message_end": self._handle_message_end,
+            "workflow_started": self._handle_workflow_started,
+            "workflow_ended": self._handle_workflow_ended,
+            "node_started": self._handle_node_started,
+            "node_finished": self._handle_node_finished
+        }
         self.conversation_ids = {}
 
+        # Values fixed for the lifetime of the agent
+        self._response_mode = "streaming" if type in (DifyType.Agent, DifyType.Workflow) else "blocking"
+        self._base_url = base_url.rstrip("/") # Remove trailing slash
+        self._chat_messages_url = self._base_url + "/chat-messages"
+        self._files_upload_url = self._base_url + "/files/upload"
+
+        self._session: aiohttp.ClientSession = None
+
     async def make_payloads(self, text: str, image_bytes: bytes = None, inputs: dict = None) -> Dict:
         payloads = {
             "inputs": inputs or {},
             "query": text,
-            "response_mode": "streaming" if self.type == DifyType.Agent or self.type == DifyType.Workflow else "blocking",
+            "response_mode": self._response_mode,
             "user": self.user,
             "auto_generate_name": False,
         }
@@ -53,6 +183,19 @@ class DifyAgent:
         
         return payloads
 
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(**self.connector_kwargs),
+                headers={"Authorization": f"Bearer {self.api_key}"}
+            )
+        return self._session
+
+    async def aclose(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
     async def upload_image(self, image_bytes: str) -> str:
         form_data = aiohttp.FormData()
         form_data.add_field("file",
@@ -61,81 +204,28 @@ class DifyAgent:
             content_type="image/png")
         form_data.add_field('user', self.user)
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                self.base_url + "/files/upload",
-                headers={"Authorization": f"Bearer {self.api_key}"},
-                data=form_data
-            ) as response:
-                response_json = await response.json()
-                if self.verbose:
-                    logger.info(f"File upload response: {json.dumps(response_json, ensure_ascii=False)}")
-                response.raise_for_status()
-                return response_json["id"]
+        session = await self._get_session()
+        async with session.post(
+            self._files_upload_url,
+            data=form_data
+        ) as response:
+            response_json = await response.json(loads=_loads)
+            if self.verbose:
+                logger.info("File upload response: %s", _LazyJSON(response_json))
+            response.raise_for_status()
+            return response_json["id"]
 
     async def process_agent_response(self, response: aiohttp.ClientResponse) -> Tuple[str, str, Dict]:
-        conversation_id = ""
-        response_text = ""
-        response_data = {}
-
-        buffer = b""
-        async for r in response.content.iter_any():
-            buffer += r
-            if b"\n\n" in buffer:
-                data, buffer = buffer.split(b"\n\n", 1)
-                try:
-                    decoded_r = data.decode("utf-8")
-                except UnicodeDecodeError:
-                    buffer = data + "\n\n" + buffer
-                    continue
-            else:
-                continue
-
-            if not decoded_r.startswith("data:"):
-                continue
+        return await self._process_stream(response, self._agent_handlers)
 
-            try:
-                chunk = json.loads(decoded_r[5:])
-            except json.JSONDecodeError:
-                continue
-
-            if self.verbose:
-                logger.debug(f"Chunk from Dify: {json.dumps(chunk, ensure_ascii=False)}")
-
-            event_type = chunk["event"]
-
-            if event_type == "agent_message":
-                conversation_id = chunk["conversation_id"]
-                response_text += chunk["answer"]
-
-            elif event_type == "agent_thought":
-                if tool := chunk.get("tool"):
-                    response_data["tool"] = tool
-                if tool_input := chunk.get("tool_input"):
-                    response_data["tool_input"] = tool_input
-    
-            elif event_type == "message_end":
-                if retriever_resources := chunk["metadata"].get("retriever_resources"):
-                    response_data["retriever_resources"] = retriever_resources
-
-            elif event_type == "message_file":
-                file_obj = {
-                    "base_url": self.base_url.rstrip("/"), # Remove trailing slash
-                    "url": chunk["url"] if chunk.get("url") else None,
-                    "id": chunk["id"] if chunk.get("id") else None,
-                    "type": chunk["type"] if chunk.get("type") else None,
-                    "belongs_to": chunk["belongs_to"] if chunk.get("belongs_to") else None,
-                    "conversation_id": chunk["conversation_id"] if chunk.get("conversation_id") else None,
-                }
-                response_data["files"] = response_data.get("files", []) + [file_obj]
-
-        return conversation_id, response_text, response_data
+    def process_agent_response_stream(self, response: aiohttp.ClientResponse) -> AsyncIterator[Tuple[Optional[str], Optional[Tuple[str, Dict]]]]:
+        return self._process_stream_fragments(response, self._agent_handlers)
 
     async def process_chatbot_response(self, response: aiohttp.ClientResponse) -> Tuple[str, str, Dict]:
-        response_json = await response.json()
+        response_json = await response.json(loads=_loads)
 
         if self.verbose:
-            logger.info(f"Response from Dify: {json.dumps(response_json, ensure_ascii=False)}")
+            logger.info("Response from Dify: %s", _LazyJSON(response_json))
 
         conversation_id = response_json["conversation_id"]
         response_text = response_json["answer"]
@@ -143,143 +233,189 @@ class DifyAgent:
 
     async def process_textgenerator_response(self, response: aiohttp.ClientResponse) -> Tuple[str, str, Dict]:
         if self.verbose:
-            logger.info(f"Response from Dify: {json.dumps(await response.json(), ensure_ascii=False)}")
+            logger.info("Response from Dify: %s", _LazyJSON(await response.json(loads=_loads)))
 
         raise Exception("TextGenerator is not supported for now.")
 
     async def process_workflow_response(self, response: aiohttp.ClientResponse) -> Tuple[str, str, Dict]:
-        conversation_id = ""
-        response_text = ""
-        response_data = {}
+        return await self._process_stream(response, self._workflow_handlers)
+
+    def process_workflow_response_stream(self, response: aiohttp.ClientResponse) -> AsyncIterator[Tuple[Optional[str], Optional[Tuple[str, Dict]]]]:
+        return self._process_stream_fragments(response, self._workflow_handlers)
+
+    async def _process_blocking_response_stream(self, response: aiohttp.ClientResponse) -> AsyncIterator[Tuple[Optional[str], Optional[Tuple[str, Dict]]]]:
+        # Blocking response modes return the whole answer at once
+        conversation_id, response_text, response_data = await self._response_processor(response)
+        yield response_text, None
+        yield None, (conversation_id, response_data)
+
+    def _new_stream_state(self) -> Dict:
+        return {
+            "conversation_id": "",
+            "response_text": "",
+            "response_data": {}
+        }
+
+    async def _process_stream(self, response: aiohttp.ClientResponse, handlers: Dict) -> Tuple[str, str, Dict]:
+        state = self._new_stream_state()
+        handlers_get = handlers.get
+        parse_frames = self._make_frame_parser()
 
-        buffer = b""
         async for r in response.content.iter_any():
-            buffer += r
-            if b"\n\n" in buffer:
-                data, buffer = buffer.split(b"\n\n", 1)
+            for chunk in parse_frames(r):
+                if handler := handlers_get(chunk["event"]):
+                    handler(chunk, state)
+
+        return state["conversation_id"], state["response_text"], state["response_data"]
+
+    async def _process_stream_fragments(self, response: aiohttp.ClientResponse, handlers: Dict) -> AsyncIterator[Tuple[Optional[str], Optional[Tuple[str, Dict]]]]:
+        state = self._new_stream_state()
+        handlers_get = handlers.get
+        parse_frames = self._make_frame_parser()
+
+        async for r in response.content.iter_any():
+            for chunk in parse_frames(r):
+                if handler := handlers_get(chunk["event"]):
+                    # Message handlers return the answer fragment they appended
+                    if fragment := handler(chunk, state):
+                        yield fragment, None
+
+        yield None, (state["conversation_id"], state["response_data"])
+
+    def _make_frame_parser(self) -> Callable[[bytes], List[Dict]]:
+        # Returns a function that buffers network reads and returns the chunks of every complete SSE frame
+
+        # Bind lookups used for every frame to locals
+        debug_enabled = self.verbose and logger.isEnabledFor(DEBUG)
+        log_debug = logger.debug
+        loads = _loads
+        JSONDecodeError = json.JSONDecodeError
+
+        buffer = bytearray()
+        buffer_extend = buffer.extend
+        buffer_find = buffer.find
+
+        def parse_frames(r: bytes) -> List[Dict]:
+            # Data already buffered has been scanned; only its last byte can start a separator
+            start = len(buffer) - 1 if buffer else 0
+            buffer_extend(r)
+
+            # A single read may contain several frames; handle all complete ones
+            chunks = []
+            while True:
+                i = buffer_find(b"\n\n", start)
+                if i < 0:
+                    break
+                data = bytes(buffer[:i])
+                del buffer[:i + 2]
+                start = 0
+
+                if not data.startswith(b"data:"):
+                    continue
+
                 try:
-                    decoded_r = data.decode("utf-8")
-                except UnicodeDecodeError:
-                    buffer = data + "\n\n" + buffer
+                    # Parse raw bytes directly; both orjson and json accept UTF-8 bytes
+                    chunk = loads(data[5:])
+                except JSONDecodeError:
                     continue
-            else:
-                continue
 
-            if not decoded_r.startswith("data:"):
-                continue
+                if debug_enabled:
+                    log_debug("Chunk from Dify: %s", _dumps(chunk))
 
-            try:
-                chunk = json.loads(decoded_r[5:])
-            except json.JSONDecodeError:
-                continue
+                chunks.append(chunk)
 
-            if self.verbose:
-                logger.debug(f"Chunk from Dify: {json.dumps(chunk, ensure_ascii=False)}")
-
-            event_type = chunk["event"]
-
-            if event_type == "message":
-                conversation_id = chunk["conversation_id"]
-                response_text += chunk["answer"]
-    
-            elif event_type == "message_end":
-                if retriever_resources := chunk["metadata"].get("retriever_resources"):
-                    response_data["retriever_resources"] = retriever_resources
-            
-            elif event_type == "workflow_started":
-                response_data["workflow_started"] = {
-                    "task_id": chunk["task_id"] if chunk.get("task_id") else None,
-                    "workflow_run_id": chunk["workflow_run_id"] if chunk.get("workflow_run_id") else None,
-                    "data": chunk["data"] if chunk.get("data") else None,
-                    "id": chunk["id"] if chunk.get("id") else None,
-                    "workflow_id": chunk["workflow_id"] if chunk.get("workflow_id") else None,
-                    "sequence_number": chunk["sequence_number"] if chunk.get("sequence_number") else None,
-                    "created_at": chunk["created_at"] if chunk.get("created_at") else None,
-                }
-
-            elif event_type == "workflow_ended":
-                response_data["workflow_ended"] = {
-                    "task_id": chunk["task_id"] if chunk.get("task_id") else None,
-                    "workflow_run_id": chunk["workflow_run_id"] if chunk.get("workflow_run_id") else None,
-                    "data": chunk["data"] if chunk.get("data") else None,
-                    "id": chunk["id"] if chunk.get("id") else None,
-                    "workflow_id": chunk["workflow_id"] if chunk.get("workflow_id") else None,
-                    "status": chunk["status"] if chunk.get("status") else None,
-                    "outputs": chunk["outputs"] if chunk.get("outputs") else None,
-                    "error": chunk["error"] if chunk.get("error") else None,
-                    "elapsed_time": chunk["elapsed_time"] if chunk.get("elapsed_time") else None,
-                    "total_tokens": chunk["total_tokens"] if chunk.get("total_tokens") else None,
-                    "total_steps": chunk["total_steps"] if chunk.get("total_steps") else None,
-                    "created_at": chunk["created_at"] if chunk.get("created_at") else None,
-                    "finished_at": chunk["finished_at"] if chunk.get("finished_at") else None,
-                }
-
-            elif event_type == "node_started":
-                response_data["node_started"] = response_data.get("node_started", []) + [{
-                    "task_id": chunk["task_id"] if chunk.get("task_id") else None,
-                    "workflow_run_id": chunk["workflow_run_id"] if chunk.get("workflow_run_id") else None,
-                    "data": chunk["data"] if chunk.get("data") else None,
-                    "id": chunk["id"] if chunk.get("id") else None,
-                    "node_id": chunk["node_id"] if chunk.get("node_id") else None,
-                    "node_type": chunk["node_type"] if chunk.get("node_type") else None,
-                    "title": chunk["title"] if chunk.get("title") else None,
-                    "index": chunk["index"] if chunk.get("index") else None,
-                    "predecessor_node_id": chunk["predecessor_node_id"] if chunk.get("predecessor_node_id") else None,
-                    "inputs": chunk["inputs"] if chunk.get("inputs") else None,
-                    "created_at": chunk["created_at"] if chunk.get("created_at") else None,
-                }]
+            return chunks
 
-            elif event_type == "node_finished":
-                response_data["node_finished"] = response_data.get("node_finished", []) + [{
-                    "task_id": chunk["task_id"] if chunk.get("task_id") else None,
-                    "workflow_run_id": chunk["workflow_run_id"] if chunk.get("workflow_run_id") else None,
-                    "data": chunk["data"] if chunk.get("data") else None,
-                    "id": chunk["id"] if chunk.get("id") else None,
-                    "node_id": chunk["node_id"] if chunk.get("node_id") else None,
-                    "node_type": chunk["node_type"] if chunk.get("node_type") else None,
-                    "title": chunk["title"] if chunk.get("title") else None,
-                    "index": chunk["index"] if chunk.get("index") else None,
-                    "predecessor_node_id": chunk["predecessor_node_id"] if chunk.get("predecessor_node_id") else None,
-                    "inputs": chunk["inputs"] if chunk.get("inputs") else None,
-                    "process_data": chunk["process_data"] if chunk.get("process_data") else None,
-                    "outputs": chunk["outputs"] if chunk.get("outputs") else None,
-                    "status": chunk["status"] if chunk.get("status") else None,
-                    "error": chunk["error"] if chunk.get("error") else None,
-                    "elapsed_time": chunk["elapsed_time"] if chunk.get("elapsed_time") else None,
-                    "execution_metadata": chunk["execution_metadata"] if chunk.get("execution_metadata") else None,
-                    "total_tokens": chunk["total_tokens"] if chunk.get("total_tokens") else None,
-                    "total_price": chunk["total_price"] if chunk.get("total_price") else None,
-                    "currency": chunk["currency"] if chunk.get("currency") else None,
-                    "created_at": chunk["created_at"] if chunk.get("created_at") else None,
-                }]            
-
-        return conversation_id, response_text, response_data
+        return parse_frames
 
-    async def invoke(self, conversation_id: str, text: str = None, image: bytes = None, inputs: dict = None, start_as_new: bool = False) -> Tuple[str, Dict]:
-        headers = {
-            "Authorization": f"Bearer {self.api_key}"
+    # Stream event handlers
+    def _handle_message(self, chunk: Dict, state: Dict) -> str:
+        state["conversation_id"] = chunk["conversation_id"]
+        answer = chunk["answer"]
+        state["response_text"] += answer
+        return answer
+
+    def _handle_agent_thought(self, chunk: Dict, state: Dict) -> None:
+        if tool := chunk.get("tool"):
+            state["response_data"]["tool"] = tool
+        if tool_input := chunk.get("tool_input"):
+            state["response_data"]["tool_input"] = tool_input
+
+    def _handle_message_end(self, chunk: Dict, state: Dict) -> None:
+        if retriever_resources := chunk["metadata"].get("retriever_resources"):
+            state["response_data"]["retriever_resources"] = retriever_resources
+
+    def _handle_message_file(self, chunk: Dict, state: Dict) -> None:
+        file_obj = {
+            "base_url": self._base_url,
+            **{k: chunk.get(k) for k in _MESSAGE_FILE_FIELDS}
         }
+        state["response_data"].setdefault("files", []).append(file_obj)
+
+    def _handle_workflow_started(self, chunk: Dict, state: Dict) -> None:
+        state["response_data"]["workflow_started"] = {k: chunk.get(k) for k in _WORKFLOW_STARTED_FIELDS}
 
+    def _handle_workflow_ended(self, chunk: Dict, state: Dict) -> None:
+        state["response_data"]["workflow_ended"] = {k: chunk.get(k) for k in _WORKFLOW_ENDED_FIELDS}
+
+    def _handle_node_started(self, chunk: Dict, state: Dict) -> None:
+        state["response_data"].setdefault("node_started", []).append({k: chunk.get(k) for k in _NODE_STARTED_FIELDS})
+
+    def _handle_node_finished(self, chunk: Dict, state: Dict) -> None:
+        state["response_data"].setdefault("node_finished", []).append({k: chunk.get(k) for k in _NODE_FINISHED_FIELDS})
+
+    async def _make_request_body(self, conversation_id: str, text: str, image: bytes, inputs: dict, start_as_new: bool) -> bytes:
         payloads = await self.make_payloads(text, image, inputs)
 
         if conversation_id and not start_as_new:
             payloads["conversation_id"] = conversation_id
 
-        async with aiohttp.ClientSession() as session:
-            if self.verbose:
-                logger.info(f"Request to Dify: {json.dumps(payloads, ensure_ascii=False)}")
+        body = _dumpb(payloads)
+
+        if self.verbose and logger.isEnabledFor(INFO):
+            logger.info("Request to Dify: %s", body.decode("utf-8"))
+
+        return body
+
+    async def _check_response(self, response: aiohttp.ClientResponse):
+        if response.status != 200:
+            logger.error("Error response from Dify: %s", _LazyJSON(await response.json(loads=_loads)))
+        response.raise_for_status()
 
-            async with session.post(
-                self.base_url + "/chat-messages",
-                headers=headers,
-                json=payloads
-            ) as response:
+    async def invoke(self, conversation_id: str, text: str = None, image: bytes = None, inputs: dict = None, start_as_new: bool = False) -> Tuple[str, Dict]:
+        body = await self._make_request_body(conversation_id, text, image, inputs, start_as_new)
+
+        session = await self._get_session()
+        async with session.post(
+            self._chat_messages_url,
+            headers={"Content-Type": "application/json"},
+            data=body
+        ) as response:
+
+            await self._check_response(response)
+
+            conversation_id, response_text, response_data = await self._response_processor(response)
 
-                if response.status != 200:
-                    logger.error(f"Error response from Dify: {json.dumps(await response.json(), ensure_ascii=False)}")
-                response.raise_for_status()
+            return conversation_id, response_text, response_data
 
-                response_processor = self.response_processors[self.type]
-                conversation_id, response_text, response_data = await response_processor(response)
+    async def stream_invoke(self, conversation_id: str, text: str = None, image: bytes = None, inputs: dict = None, start_as_new: bool = False) -> AsyncIterator[Tuple[Optional[str], Optional[Tuple[str, Dict]]]]:
+        # Yields (fragment, None) for each piece of the answer, then (None, (conversation_id, response_data)) at the end.
+        # The response stays open until this generator finishes; consumers that may stop early should
+        # wrap it with contextlib.aclosing() (or call aclose()) to release the connection right away.
+        body = await self._make_request_body(conversation_id, text, image, inputs, start_as_new)
 
-                return conversation_id, response_text, response_data
+        session = await self._get_session()
+        async with session.post(
+            self._chat_messages_url,
+            headers={"Content-Type": "application/json"},
+            data=body
+        ) as response:
+
+            await self._check_response(response)
+
+            items = self._response_stream_processor(response)
+            try:
+                async for item in items:
+                    yield item
+            finally:
+                await items.aclose()
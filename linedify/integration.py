@@ -232,3 +232,4 @@ class LineDifyIntegrator:
     # Application lifecycle
     async def shutdown(self):
         await self.line_api_client.close()
+        await self.dify_agent.aclose()
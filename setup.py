@@ -13,6 +13,7 @@ setup(
     long_description_content_type="text/markdown",
     packages=find_packages(exclude=["examples*", "tests*"]),
     install_requires=["aiohttp==3.9.5", "line-bot-sdk==3.11.0", "fastapi==0.111.0", "uvicorn==0.30.1", "SQLAlchemy==2.0.31"],
+    extras_require={"fast": ["orjson==3.10.6"]},
     license="Apache v2",
     classifiers=[
         "Programming Language :: Python :: 3"
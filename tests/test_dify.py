@@ -1,16 +1,58 @@
 import pytest
+import pytest_asyncio
+import json
 import os
 from linedify import DifyAgent, DifyType
 
+
+class FakeStreamContent:
+    def __init__(self, parts):
+        self.parts = parts
+
+    async def iter_any(self):
+        for part in self.parts:
+            yield part
+
+
+class FakeStreamResponse:
+    def __init__(self, parts):
+        self.content = FakeStreamContent(parts)
+
+
+def to_sse(events):
+    return b"".join(b"data: " + json.dumps(e, ensure_ascii=False).encode("utf-8") + b"\n\n" for e in events)
+
+
+@pytest.fixture
+def offline_agent():
+    return DifyAgent(
+        api_key="test_api_key",
+        base_url="http://localhost/v1/",
+        user="test_user",
+        type=DifyType.Agent
+    )
+
+
 @pytest.fixture
-def dify_agent():
+def offline_workflow_agent():
     return DifyAgent(
+        api_key="test_api_key",
+        base_url="http://localhost/v1",
+        user="test_user",
+        type=DifyType.Workflow
+    )
+
+@pytest_asyncio.fixture
+async def dify_agent():
+    agent = DifyAgent(
         api_key=os.environ.get("DIFY_API_KEY"),
         base_url=os.environ.get("DIFY_BASE_URL"),
         user=os.environ.get("DIFY_USER"),
         type=DifyType.Agent,
         verbose=True
     )
+    yield agent
+    await agent.aclose()
 
 @pytest.fixture
 def image_bytes():
@@ -64,6 +106,23 @@ async def test_invoke(dify_agent):
     assert conversation_id2 == conversation_id
 
 
+@pytest.mark.asyncio
+async def test_stream_invoke(dify_agent):
+    fragments = []
+    final = None
+    async for fragment, result in dify_agent.stream_invoke(conversation_id=None, text="This is a test. Respond success."):
+        if result is None:
+            fragments.append(fragment)
+        else:
+            final = result
+
+    assert len(fragments) > 0
+    assert "success" in "".join(fragments).lower()
+    conversation_id, response_data = final
+    assert response_data == {}
+    assert conversation_id is not None
+
+
 @pytest.mark.asyncio
 async def test_invoke_with_image(dify_agent, image_bytes):
     conversation_id, response_text, response_data = await dify_agent.invoke(conversation_id=None, text="what's this? Answer in English.", image=image_bytes)
@@ -81,4 +140,99 @@ async def test_invoke_and_download_image(dify_agent):
     assert len(response_data["files"]) > 0
     for file in response_data["files"]:
         assert file["url"] is not None
-        assert file["id"] is not None
\ No newline at end of file
+        assert file["id"] is not None
+
+@pytest.mark.asyncio
+async def test_process_workflow_response_node_fields(offline_workflow_agent):
+    events = [
+        {"event": "node_started", "node_id": "n1", "index": 0, "title": ""},
+        {"event": "node_finished", "node_id": "n1", "index": 0, "total_tokens": 0, "status": "succeeded"},
+    ]
+    _, _, response_data = await offline_workflow_agent.process_workflow_response(FakeStreamResponse([to_sse(events)]))
+
+    node_started = response_data["node_started"][0]
+    assert node_started["index"] == 0   # Falsy but present values are kept
+    assert node_started["title"] == ""
+    assert node_started["inputs"] is None   # Missing fields are set to None
+
+    node_finished = response_data["node_finished"][0]
+    assert node_finished["index"] == 0
+    assert node_finished["total_tokens"] == 0
+    assert node_finished["status"] == "succeeded"
+    assert node_finished["error"] is None
+
+
+@pytest.mark.asyncio
+async def test_session_reuse(offline_workflow_agent):
+    session = await offline_workflow_agent._get_session()
+    assert await offline_workflow_agent._get_session() is session
+
+    await offline_workflow_agent.aclose()
+    assert session.closed
+    assert offline_workflow_agent._session is None
+
+    # A new session is created on the next request after closing
+    new_session = await offline_workflow_agent._get_session()
+    assert new_session is not session
+    assert not new_session.closed
+
+    await offline_workflow_agent.aclose()
+
+
+AGENT_EVENTS = [
+    {"event": "agent_message", "conversation_id": "conv1", "answer": "こんにちは"},
+    {"event": "agent_thought", "tool": "dalle3", "tool_input": "{}"},
+    {"event": "message_file", "url": "/files/1.png", "id": "file1", "type": "image", "belongs_to": "assistant", "conversation_id": "conv1"},
+    {"event": "agent_message", "conversation_id": "conv1", "answer": ", world"},
+    {"event": "message_end", "metadata": {}},
+]
+
+
+def split_bytes(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("size", [1, 2, 7, None])   # None: the whole stream in one read
+async def test_process_agent_response_splits(offline_agent, size):
+    data = b"event: ping\n\n" + to_sse(AGENT_EVENTS)
+    parts = [data] if size is None else split_bytes(data, size)
+
+    conversation_id, response_text, response_data = await offline_agent.process_agent_response(FakeStreamResponse(parts))
+
+    assert conversation_id == "conv1"
+    assert response_text == "こんにちは, world"
+    assert response_data["tool"] == "dalle3"
+    assert response_data["files"] == [{
+        "base_url": "http://localhost/v1",
+        "url": "/files/1.png",
+        "id": "file1",
+        "type": "image",
+        "belongs_to": "assistant",
+        "conversation_id": "conv1",
+    }]
+
+
+@pytest.mark.asyncio
+async def test_process_agent_response_separator_across_reads(offline_agent):
+    first, second = to_sse(AGENT_EVENTS[:1]), to_sse(AGENT_EVENTS[3:4])
+    # The first read ends with the first newline of the separator, and the next read carries the second
+    parts = [first[:-1], first[-1:] + second]
+
+    conversation_id, response_text, _ = await offline_agent.process_agent_response(FakeStreamResponse(parts))
+
+    assert conversation_id == "conv1"
+    assert response_text == "こんにちは, world"
+
+
+@pytest.mark.asyncio
+async def test_process_agent_response_stream(offline_agent):
+    parts = split_bytes(to_sse(AGENT_EVENTS), 3)
+    items = [item async for item in offline_agent.process_agent_response_stream(FakeStreamResponse(parts))]
+
+    assert items[:-1] == [("こんにちは", None), (", world", None)]
+    fragment, (conversation_id, response_data) = items[-1]
+    assert fragment is None
+    assert conversation_id == "conv1"
+    assert response_data["tool"] == "dalle3"
+    assert len(response_data["files"]) == 1
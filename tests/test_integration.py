@@ -1,4 +1,5 @@
 import pytest
+import pytest_asyncio
 import json
 import os
 from linebot.v3.webhooks import MessageEvent, PostbackEvent, FollowEvent, ImageMessageContent, StickerMessageContent, LocationMessageContent, ContentProvider
@@ -6,8 +7,8 @@ from linebot.v3.messaging import TextMessage
 from linedify import LineDify, DifyType
 
 
-@pytest.fixture
-def line_dify():
+@pytest_asyncio.fixture
+async def line_dify():
     ld = LineDify(
         line_channel_access_token=os.environ.get("YOUR_CHANNEL_ACCESS_TOKEN"),
         line_channel_secret=os.environ.get("YOUR_CHANNEL_SECRET"),
@@ -36,7 +37,8 @@ def line_dify():
         return AsyncIteratorWrapper()
 
     ld.line_api.get_message_content = get_message_content
-    return ld
+    yield ld
+    await ld.shutdown()
 
 
 @pytest.fixture
@@ -201,3 +203,13 @@ async def test_end_user_mode(line_dify):
     assert "hello" in reply_messages[0].text.lower()
     assert line_dify.dify_agent.user == "U1234xx5f678x90x123456x78x9012xx3"
     line_dify.end_user_mode = False
+
+
+@pytest.mark.asyncio
+async def test_shutdown_closes_dify_session(line_dify):
+    session = await line_dify.dify_agent._get_session()
+
+    await line_dify.shutdown()
+
+    assert session.closed
+    assert line_dify.dify_agent._session is None